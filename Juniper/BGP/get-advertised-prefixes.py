@@ -7,7 +7,7 @@
 # >>>OUTPUT
 # The script will write 3 types of files:
 #
-# 1) w.x.y.z-prefixes.csv - contains a list of all prefixes for that peer
+# 1) w.x.y.z-prefixes.csv - contains a list of all prefixes for that peer, sorted by prefix
 #
 # 2) allPrefixPeers.csv - contains all unique prefixes and what peers they are advertised to
 #
@@ -21,6 +21,10 @@
 #
 # python / python3 get-advertised-prefixes.py
 #
+# Add -v to also display every prefix on the screen:
+#
+# python / python3 get-advertised-prefixes.py -v
+#
 # >>>REQUIREMENTS
 # Local executing environment:
 # 1) Python 3
@@ -36,12 +40,19 @@
 #    set system services netconf ssh
 #    commit confirmed
 #
+import contextlib
+import heapq
+import itertools
 import os
+import queue
 import sys
 import pprint
 import csv
 import operator
 import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from jnpr.junos import Device
 from getpass import getpass
 from jnpr.junos.exception import ConnectError
@@ -49,126 +60,205 @@ from lxml import etree
 from os import path
 
 router_list = "juniper-bgp-routers.txt"
+verbose = "-v" in sys.argv
+max_workers = 16
+write_queue_size = 4
+write_buffering = 1 << 20  # 1 MiB, so large CSV files need fewer writes
+strip_whitespace = str.maketrans('', '', ' \t\r\n')
+router_pattern = re.compile(r'r([\d.:a-fA-F]+)$')
+peer_pattern = re.compile(r'p([\d.:a-fA-F]+)$')
+print_lock = threading.Lock()
+
+# Compiled once, then evaluated against each route (rt) of an RPC reply.
+# The rows only need plain str values, so smart strings are turned off.
+xpath_prefix = etree.XPath('string(rt-destination)', smart_strings=False)
+xpath_active = etree.XPath('string(rt-entry/active-tag)', smart_strings=False)
+xpath_protocol = etree.XPath('string(rt-entry/protocol-name)', smart_strings=False)
+xpath_as = etree.XPath('string(rt-entry/as-path)', smart_strings=False)
+xpath_nexthop = etree.XPath('string(rt-entry/nh/to)', smart_strings=False)
+
+
+def safe_print(*args, **kwargs):
+    """Print without interleaving output from other threads
+    """
+    with print_lock:
+        print(*args, **kwargs)
 
 
-def node_values_list(xml_doc, xpath_expr):
-    """Pull text elements using XPath
+def route_rows(peer, rpc_reply):
+    """Return the routes of an RPC reply as rows in the per peer CSV column order
     """
-    return [x.text for x in xml_doc.xpath(xpath_expr)]
+    return [(peer,
+             xpath_active(rt),
+             xpath_prefix(rt),
+             xpath_protocol(rt),
+             xpath_nexthop(rt),
+             xpath_as(rt)) for rt in rpc_reply.iter('rt')]
 
 
-def rpc_execute(rpc_call, hostname, username, password):
-    """Standard RPC caller
+def run_rpcs(hostname, username, password, bgp_peers):
+    """Get the advertised prefix rows of each peer over a single NETCONF session
     """
-    try:
-        with Device(host=hostname, user=username, passwd=password) as dev:
-            rpc_return = dev.execute(rpc_call)
-    except ConnectError as err:
-        print("ERROR - cannot connect to {}, {}".format(hostname, err))
-        sys.exit(1)
-    except Exception as err:
-        print(err)
-        sys.exit(1)
+    # One RPC is built per router, only the neighbor changes for each peer
+    rpc = etree.Element('get-route-information')
+    etree.SubElement(rpc, 'advertising-protocol-name').text = 'bgp'
+    neighbor = etree.SubElement(rpc, 'neighbor')
+    rpc_returns = []
+    # Facts are never used, and normalize strips whitespace from the replies
+    with Device(host=hostname, user=username, passwd=password,
+                gather_facts=False, normalize=True) as dev:
+        for bgp_peer in bgp_peers:
+            neighbor.text = bgp_peer
+            # Only the rows are kept, so each reply tree is freed before the
+            # next peer is queried
+            rpc_returns.append(route_rows(bgp_peer, dev.execute(rpc)))
+
+    return rpc_returns
+
+
+def parse_prefixes(prefix_files):
+    """Provide multiple CSV output files for prefixes and peers
+    """
+    # Only the per peer files written this run are merged. Each one is
+    # already sorted by prefix, so merge them in order and build both
+    # output files in a single pass
+    with contextlib.ExitStack() as stack:
+        readers = []
+        for file_name in prefix_files:
+            reader = csv.reader(stack.enter_context(
+                open(file_name, newline='')))
+            next(reader, None)  # skip the header
+            readers.append(reader)
+        merged = heapq.merge(
+            *readers, key=operator.itemgetter(2), reverse=True)
+
+        # Output a CSV file that contains all prefixes and peers, with the
+        # prefix moved to the first column
+        sorted_file = stack.enter_context(open(
+            'allSortedByPrefix.csv', 'w', newline='', buffering=write_buffering))
+        sorted_writer = csv.writer(sorted_file)
+        sorted_writer.writerow(
+            ["Prefix", "Peer", "Active", "Protocol", "Nexthop", "AS Path"])
+        sorted_columns = operator.itemgetter(2, 0, 1, 3, 4, 5)
+
+        # Output a CSV file that contains each prefix (one per line), with the matching peer(s) they are advertised to
+        peers_file = stack.enter_context(open(
+            'allPrefixPeers.csv', 'w', newline='', buffering=write_buffering))
+        peers_writer = csv.writer(peers_file)
+        peers_writer.writerow(["Prefix", "Peers"])
+
+        # The rows are sorted so each prefix's rows are together
+        unique_peers = set()
+        all_prefix_totals = 0
+        lines = ["Prefix list"]
+        for prefix, rows in itertools.groupby(merged, key=operator.itemgetter(2)):
+            rows = list(rows)
+            sorted_writer.writerows(map(sorted_columns, rows))
+            cur_peers = [row[0] for row in rows]  # row[0] should be the peer
+            unique_peers.update(cur_peers)
+            peers_writer.writerow([prefix] + cur_peers)
+            if verbose:
+                lines.append("Prefix: %s --> %s" % (prefix, ', '.join(cur_peers)))
+            all_prefix_totals += 1
 
-    return rpc_return
+    print("//" * 40)
+    if verbose:
+        print("\n".join(lines))
+    print("Total global prefixes: " + str(all_prefix_totals))
+    return
 
 
-def find_peers(prefix, sorted_list):
-    """Given a presorted list, return all peers for a prefix
+def csv_writer(write_queue, written_files, failed_files):
+    """Write each queued (file name, header, rows) until None is queued,
+    recording the name of each file written or that failed to write
     """
-    result = []
-    for row in sorted_list:
-        if row[0] == prefix:  # row[0] should be the prefix
-            result.append(row[1])  # row[1] should be the peer IP
-    return result
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        file_name, header, rows = item
+        try:
+            with open(file_name, 'w', newline='', buffering=write_buffering) as file:
+                writer = csv.writer(file)
+                writer.writerow(header)
+                writer.writerows(rows)
+            written_files.append(file_name)
+        except Exception as err:
+            # Keep draining the queue, or the main thread would block on put()
+            safe_print("ERROR - cannot write {}, {}".format(file_name, err))
+            failed_files.append(file_name)
+    return
 
 
-def parse_prefixes():
-    """Provide multiple CSV output files for prefixes and peers
+def write_peer_prefixes(hostname, all_peer_prefixes, write_queue):
+    """Display and queue a CSV file of the prefixes for each peer
     """
-    prefix_files = []
-    for file in os.listdir():
-        if "-prefixes.csv" in file:
-            prefix_files.append(file)
-
-    # I need a CSV file to help me sort things
-    header = 0
-    if os.path.exists('temp.csv'):
-        os.remove('temp.csv')
-    for file in prefix_files:
-        with open(file, newline='') as file:
-            reader = csv.DictReader(file)
-            with open('temp.csv', 'a', newline='') as tempfile:
-                writer = csv.DictWriter(
-                    tempfile, ["Prefix", "Peer", "Active", "Protocol", "Nexthop", "AS Path"])
-                if header == 0:
-                    writer.writeheader()
-                    header = 1
-                writer.writerows(reader)
-            for row in reader:
-                print(row)
-
-    # Output a CSV file that contains all prefixes and peers
-    all_advertisements = csv.reader(open('temp.csv'))
-    sorted_list = sorted(all_advertisements,
-                         key=operator.itemgetter(0), reverse=True)
-    with open('allSortedByPrefix.csv', 'w', newline='') as tempfile:
-        writer = csv.writer(tempfile)
-        for row in sorted_list:
-            writer.writerow(row)
-
-    # Find the uniques
-    unique_peers = []
-    unique_prefixes = []
-    for row in sorted_list:
-        if row[1] not in unique_peers:  # row[1] should be the peer
-            if row[1] != "Peer":
-                unique_peers.append(row[1])
-        if row[0] not in unique_prefixes:  # row[0] should be the prefix
-            if row[0] != "Prefix":
-                unique_prefixes.append(row[0])
-
-    print("//" * 40)
-
-    # Output a CSV file that contains each prefix (one per line), with the matching peer(s) they are advertised to
-    with open('allPrefixPeers.csv', 'w', newline='') as file:
-        writer = csv.writer(file)
-        header = ["Prefix", "Peers"]
-        writer.writerow(header)
-        all_prefix_totals = 0
-        print("Prefix list")
-        for prefix in unique_prefixes:
-            cur_peers = find_peers(prefix, sorted_list)
-            print("Prefix: {} --> {}".format(prefix, ', '.join(cur_peers)))
-            row = [[prefix] + cur_peers]
-            writer.writerows(row)
-            all_prefix_totals += 1
-        print("Total global prefixes: " + str(all_prefix_totals))
+    safe_print("//" * 40)
+    safe_print("Results from: {}".format(hostname))
+    for peer, all_prefixes in all_peer_prefixes.items():
+        lines = ["Peer: " + peer]
+        if verbose:
+            row_format = "%-2s%-25s%-10s%-15s%-15s"
+            lines.append(row_format % (
+                " ", "Prefix", "Protocol", "Next Hop", "AS Path"))
+            for _, active, prefix, protocol, nexthop, as_path in all_prefixes:
+                lines.append(row_format % (
+                    active, prefix, protocol, nexthop, as_path))
+        lines.append("Prefix total: " + str(len(all_prefixes)))
+        safe_print("\n".join(lines))
+        # For each peer we are going to output a CSV with all prefixes, the
+        # writer thread saves it while the next peer is being processed. It is
+        # sorted by prefix so parse_prefixes() can merge the files in order.
+        all_prefixes.sort(key=operator.itemgetter(2), reverse=True)
+        cur_file = peer + "-prefixes.csv"
+        header = ["Peer", "Active", "Prefix",
+                  "Protocol", "Nexthop", "AS Path"]
+        write_queue.put((cur_file, header, all_prefixes))
     return
 
 
-def input_file_check(router_list):
-    """Enable a basic input file check
+def parse_router_file(router_list):
+    """Check the input file and return a list of (router, [peers])
     """
     if os.path.exists(router_list):
         print("Found device file ({}): OK".format(router_list))
     else:
+        raise FileNotFoundError(router_list)
+
+    # Keyed by router so each router and peer is only queried once
+    routers = {}
+    with open(router_list) as f:
+        for line in f:
+            line_items = line.translate(strip_whitespace).split(',')
+            if line_items[0].startswith(';') or not line_items[0]:
+                continue
+            router = router_pattern.match(line_items[0])
+            # Empty tokens, e.g. from a trailing comma, are ignored
+            peers = [peer_pattern.match(peer) for peer in line_items[1:] if peer]
+            if router is None or not peers or None in peers:
+                raise ValueError(line.strip())
+            print("Processing line:", line.strip())
+            router_peers = routers.setdefault(router.group(1), {})
+            router_peers.update(dict.fromkeys(peer.group(1) for peer in peers))
+
+    print("Line check: OK")
+    return [(router, list(router_peers)) for router, router_peers in routers.items()]
+
+
+def main():
+
+    try:
+        routers = parse_router_file(router_list)
+    except FileNotFoundError:
         print('''
 Unable to find device list >>>{}<<<, please verify it exists and/or update the
 variable ___router_list___ at the top of this script file to point to a new one.
 
 Script error, exiting.'''.format(router_list))
         sys.exit(1)
-
-    with open(router_list) as f:
-        for line in f:
-            if ";" not in line:
-                if "r" in line:
-                    if "p" in line:
-                        print("Processing line:", line.strip())
-                    else:
-                        print("ERROR with line:", line.strip())
-                        print('''
+    except ValueError as err:
+        print("ERROR with line:", err)
+        print('''
 Your {} file may contain invalid entries, please double check it.
 
 Examples:
@@ -181,15 +271,7 @@ r10.20.30.40, p4.4.4.4
 r192.168.1.22, p5.5.5.5, p6.6.6.6, p7.7.7.7
 
 '''.format(router_list))
-                        sys.exit(1)
-
-    print("Line check: OK")
-    return
-
-
-def main():
-
-    input_file_check(router_list)
+        sys.exit(1)
 
     print('''
 This script connects to each device in the supplied file: >>>''' + router_list + '''<<< 
@@ -202,104 +284,77 @@ written to files in the directory that this script is executed from.
     ''')
     username = input("Username: ")
     password = getpass("Password: ")
-    with open(router_list) as f:
-        for line in f:
-            if ";" not in line:
-                line_items = line.split(',')
-                hostname = line_items[0].replace('r', '')
-                external_peers = []
-                for peer in line_items:
-                    if "p" in peer:
-                        external_peers.append(peer.replace(
-                            'p', '').replace('\n', '').replace(' ', ''))
-                print("//" * 40)
-                print("Connecting to: {} ...".format(hostname))
-
-                # Get prefixes from each External BGP Peer
-                all_peer_prefixes = {}
-                for bgp_peer in external_peers:
-                    print("Processing BGP peer {} ...".format(bgp_peer))
-
-                    rpc = '''
-                    <get-route-information>
-                    <advertising-protocol-name>bgp</advertising-protocol-name>
-                    <neighbor>''' + bgp_peer + '''</neighbor>
-                    </get-route-information>
-                    '''
-
-                    all_peer_prefixes[bgp_peer] = rpc_execute(
-                        rpc, hostname, username, password)
-
-                # Process prefixes for each peer
-                xpath_rt = '//rt-destination'
-                xpath_active = '//active-tag'
-                xpath_protocol = '//protocol-name'
-                xpath_as = '//as-path'
-                xpath_nexthop = '//to'
-
-                peer_index = 0
-                for peer in all_peer_prefixes:
-                    all_prefixes = {}
-                    print("Peer: " + peer)
-
-                    prefixes = node_values_list(
-                        all_peer_prefixes[peer], xpath_rt)
-                    prefixes_active = node_values_list(
-                        all_peer_prefixes[peer], xpath_active)
-                    prefixes_protocol = node_values_list(
-                        all_peer_prefixes[peer], xpath_protocol)
-                    prefixes_as = node_values_list(
-                        all_peer_prefixes[peer], xpath_as)
-                    prefixes_next_hop = node_values_list(
-                        all_peer_prefixes[peer], xpath_nexthop)
-                    for prefix_index in range(0, len(prefixes)):
-                        all_prefixes[prefix_index] = {
-                            "prefix": prefixes[prefix_index],
-                            "active": prefixes_active[prefix_index],
-                            "protocol": prefixes_protocol[prefix_index],
-                            "AS": prefixes_as[prefix_index].replace('\n', ''),
-                            "nexthop": prefixes_next_hop[prefix_index]
-                        }
-                    peer_index += 1
-                    prefix_total = 0
-                    print("{:2}{:25}{:10}{:15}{:15}".format(
-                        " ", "Prefix", "Protocol", "Next Hop", "AS Path"))
-                    for index in all_prefixes:
-                        print("{:2}{:25}{:10}{:15}{:15}".format(
-                            all_prefixes[index]["active"],
-                            all_prefixes[index]["prefix"],
-                            all_prefixes[index]["protocol"],
-                            all_prefixes[index]["nexthop"],
-                            all_prefixes[index]["AS"]
-                        ))
-                        prefix_total += 1
-                    print("Prefix total: " + str(prefix_total))
-                    # For each peer we are going to output a CSV with all prefixes
-                    cur_file = peer + "-prefixes.csv"
-                    with open(cur_file, 'w', newline='') as file:
-                        writer = csv.writer(file)
-                        header = ["Peer", "Active", "Prefix",
-                                  "Protocol", "Nexthop", "AS Path"]
-                        writer.writerow(header)
-                        for index in all_prefixes:
-                            row = []
-                            row = peer, all_prefixes[index]["active"], all_prefixes[index]["prefix"], all_prefixes[
-                                index]["protocol"], all_prefixes[index]["nexthop"], all_prefixes[index]["AS"]
-                            writer.writerow(row)
-
-        # After NETCONF is complete, go through and output more files
-        parse_prefixes()
-        print("//" * 40)
-        print("Script complete.")
-        print('''
+
+    # Per peer CSV files are written by their own thread
+    write_queue = queue.Queue(maxsize=write_queue_size)
+    written_files = []
+    failed_files = []
+    writer_thread = threading.Thread(
+        target=csv_writer, args=(write_queue, written_files, failed_files),
+        daemon=True)
+    writer_thread.start()
+
+    # Connect to every router at once, one NETCONF session per router
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque()
+        failed_routers = []
+        for hostname, external_peers in routers:
+            safe_print("Connecting to: {} ...".format(hostname))
+
+            # Get prefixes from each External BGP Peer
+            future = executor.submit(
+                run_rpcs, hostname, username, password, external_peers)
+            futures.append((future, hostname, external_peers))
+
+        # Results are handled in router file order so the output is the same
+        # on every run, the routers are still queried at the same time
+        while futures:
+            # Drop each future once done so its replies can be freed
+            future, hostname, external_peers = futures.popleft()
+            # A router that fails is reported and skipped, the others carry on
+            try:
+                rpc_returns = future.result()
+            except ConnectError as err:
+                safe_print("ERROR - cannot connect to {}, {}".format(hostname, err))
+                failed_routers.append(hostname)
+                continue
+            except Exception as err:
+                safe_print("ERROR - {}, {}".format(hostname, err))
+                failed_routers.append(hostname)
+                continue
+            all_peer_prefixes = dict(zip(external_peers, rpc_returns))
+            write_peer_prefixes(hostname, all_peer_prefixes, write_queue)
+
+    # Wait for every per peer CSV file to be written
+    write_queue.put(None)
+    writer_thread.join()
+
+    # After NETCONF is complete, go through and output more files. The files
+    # are merged in router file order, a peer listed under more than one
+    # router was written last by the last of those routers in the file.
+    written_files = set(written_files)
+    prefix_files = [peer + "-prefixes.csv"
+                    for _, external_peers in routers for peer in external_peers]
+    parse_prefixes([file_name for file_name in dict.fromkeys(prefix_files)
+                    if file_name in written_files])
+    print("//" * 40)
+    print("Script complete.")
+    print('''
 The script wrote 3 types of files for you in this directory:
 1) w.x.y.z-prefixes.csv - contains a list of all prefixes for that peer
 2) allPrefixPeers.csv - contains all unique prefixes and what peers they are advertised to
 3) allSortedByPrefix.csv - contains all peers and all prefixes, sorted by prefix
-        ''')
-        # Temp file cleanup
-        if os.path.exists('temp.csv'):
-                os.remove('temp.csv')
+    ''')
+    if failed_routers:
+        print("These routers failed, their peers are not in the files above:")
+        for hostname in failed_routers:
+            print("  " + hostname)
+    if failed_files:
+        print("These files could not be written, their peers are not in the files above:")
+        for file_name in failed_files:
+            print("  " + file_name)
+    if failed_routers or failed_files:
+        sys.exit(1)
 
 
 if __name__ == "__main__":